@@ -0,0 +1,241 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True, initializedcheck=False
+
+"""
+Compiled forward-backward kernel for the Hidden Markov Model
+"""
+
+import numpy as np
+
+from cython.parallel import parallel, prange
+from libc.stdlib cimport malloc, free
+
+
+ctypedef fused stack_t:
+    float
+    unsigned short
+
+
+cdef int _n_threads = 1
+
+
+def set_threads(int n_jobs):
+
+    """
+    Sets the number of threads used by the parallel kernels
+
+    Args:
+        n_jobs (int): The number of threads.
+    """
+
+    global _n_threads
+
+    _n_threads = max(1, n_jobs)
+
+
+cdef void fb_pixel(const stack_t* ts,
+                   const float* tm,
+                   bint uniform,
+                   float alpha,
+                   float beta,
+                   bint skip_constant,
+                   int n_steps,
+                   int n_labels,
+                   float* forward,
+                   float* backward,
+                   float* out) noexcept nogil:
+
+    """
+    Runs forward-backward over one sample. `ts`, `forward`, `backward`,
+    and `out` are (M x N) row-major arrays, and `tm` is the (N x N)
+    row-major transition matrix.
+    """
+
+    cdef:
+        int t, k, j, label, constant_label
+        float sample_max = 0
+        float acc, v_sum, Z
+
+    for k in range(0, n_steps * n_labels):
+        if ts[k] > sample_max:
+            sample_max = ts[k]
+
+    if sample_max == 0:
+
+        for k in range(0, n_steps * n_labels):
+            out[k] = 0
+
+        return
+
+    if skip_constant:
+
+        constant_label = -1
+
+        for t in range(0, n_steps):
+
+            label = 0
+
+            for k in range(1, n_labels):
+                if ts[t*n_labels+k] > ts[t*n_labels+label]:
+                    label = k
+
+            if t == 0:
+                constant_label = label
+            elif label != constant_label:
+                constant_label = -1
+                break
+
+        if constant_label >= 0:
+
+            for k in range(0, n_steps * n_labels):
+                out[k] = 0
+
+            for t in range(0, n_steps):
+                out[t*n_labels+constant_label] = 1
+
+            return
+
+    # Compute forward messages
+    for k in range(0, n_labels):
+        forward[k] = ts[k]
+
+    for t in range(1, n_steps):
+
+        Z = 0
+        v_sum = 0
+
+        if uniform:
+
+            for j in range(0, n_labels):
+                v_sum += forward[(t-1)*n_labels+j]
+
+        for k in range(0, n_labels):
+
+            if uniform:
+                acc = alpha * forward[(t-1)*n_labels+k] + beta * v_sum
+            else:
+
+                acc = 0
+
+                for j in range(0, n_labels):
+                    acc += tm[j*n_labels+k] * forward[(t-1)*n_labels+j]
+
+            forward[t*n_labels+k] = ts[t*n_labels+k] * acc
+            Z += forward[t*n_labels+k]
+
+        if Z > 0:
+
+            for k in range(0, n_labels):
+                forward[t*n_labels+k] /= Z
+
+    # Compute backward messages
+    for k in range(0, n_labels):
+        backward[(n_steps-1)*n_labels+k] = 1
+
+    for t in range(n_steps-1, 0, -1):
+
+        Z = 0
+        v_sum = 0
+
+        if uniform:
+
+            for j in range(0, n_labels):
+                v_sum += ts[t*n_labels+j] * backward[t*n_labels+j]
+
+        for k in range(0, n_labels):
+
+            if uniform:
+                acc = alpha * ts[t*n_labels+k] * backward[t*n_labels+k] + beta * v_sum
+            else:
+
+                acc = 0
+
+                for j in range(0, n_labels):
+                    acc += tm[k*n_labels+j] * ts[t*n_labels+j] * backward[t*n_labels+j]
+
+            backward[(t-1)*n_labels+k] = acc
+            Z += acc
+
+        if Z > 0:
+
+            for k in range(0, n_labels):
+                backward[(t-1)*n_labels+k] /= Z
+
+    # Normalize the belief
+    for t in range(0, n_steps):
+
+        Z = 0
+
+        for k in range(0, n_labels):
+            Z += forward[t*n_labels+k] * backward[t*n_labels+k]
+
+        if Z == 0:
+            Z = 1
+
+        for k in range(0, n_labels):
+            out[t*n_labels+k] = forward[t*n_labels+k] * backward[t*n_labels+k] / Z
+
+
+def fb_block(stack_t[:, :, ::1] d_stack,
+             transition_matrix,
+             transition_matrix_t,
+             bint uniform,
+             float alpha,
+             float beta,
+             bint skip_constant,
+             int n_steps,
+             int n_labels,
+             Py_ssize_t n_samples,
+             float[:, :, ::1] out):
+
+    """
+    Uses the Forward/Backward algorithm to compute marginal probabilities
+    for each sample of a block. Samples are processed in parallel.
+
+    Args:
+        d_stack (3d array): A 3d array (S x M x N), where S = samples, M = time steps,
+            and N = class labels. Quantized (integer) stacks are used as is because a constant
+            scale per time step cancels when the messages are normalized.
+        transition_matrix (2d array): The state transition matrix (N x N).
+        transition_matrix_t (2d array): The transposed state transition matrix (N x N). Unused,
+            the kernel reads `transition_matrix` in both directions.
+        uniform (bool): Whether the transition matrix is uniform, T = alpha * I + beta * 1. If True,
+            `alpha` and `beta` are used in place of the dense matrices.
+        alpha (float): The diagonal weight of a uniform transition matrix.
+        beta (float): The off-diagonal weight of a uniform transition matrix.
+        skip_constant (bool): Whether to skip samples whose input argmax is the same class at every
+            time step. These samples get a belief of 1 for that class. Only valid when the belief
+            argmax is all that is kept and the transition matrix is uniform with `alpha` > 0.
+        n_steps (int): The number of time steps.
+        n_labels (int): The number of class labels.
+        n_samples (int): The number of samples.
+        out (3d array): The output belief (S x M x N), written in place.
+    """
+
+    cdef:
+        float[:, ::1] tm = np.ascontiguousarray(transition_matrix, dtype='float32')
+        Py_ssize_t s
+        float* forward
+        float* backward
+
+    with nogil, parallel(num_threads=_n_threads):
+
+        # Per-thread message arrays
+        forward = <float*>malloc(n_steps * n_labels * sizeof(float))
+        backward = <float*>malloc(n_steps * n_labels * sizeof(float))
+
+        for s in prange(n_samples, schedule='static'):
+
+            fb_pixel(&d_stack[s, 0, 0],
+                     &tm[0, 0],
+                     uniform,
+                     alpha,
+                     beta,
+                     skip_constant,
+                     n_steps,
+                     n_labels,
+                     forward,
+                     backward,
+                     &out[s, 0, 0])
+
+        free(forward)
+        free(backward)
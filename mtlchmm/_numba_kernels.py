@@ -0,0 +1,184 @@
+"""
+Numba kernels for the Hidden Markov Model
+"""
+
+import numpy as np
+
+from numba import config, njit, prange, set_num_threads
+
+
+def set_threads(n_jobs):
+
+    """
+    Sets the number of threads used by the parallel kernels
+
+    Args:
+        n_jobs (int): The number of threads.
+    """
+
+    set_num_threads(max(1, min(n_jobs, config.NUMBA_NUM_THREADS)))
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def fb_block(d_stack,
+             transition_matrix,
+             transition_matrix_t,
+             uniform,
+             alpha,
+             beta,
+             skip_constant,
+             n_steps,
+             n_labels,
+             n_samples,
+             out):
+
+    """
+    Uses the Forward/Backward algorithm to compute marginal probabilities
+    for each sample of a block. Samples are processed in parallel.
+
+    Args:
+        d_stack (3d array): A 3d array (S x M x N), where S = samples, M = time steps,
+            and N = class labels. Quantized (integer) stacks are used as is because a constant
+            scale per time step cancels when the messages are normalized.
+        transition_matrix (2d array): The state transition matrix (N x N).
+        transition_matrix_t (2d array): The transposed state transition matrix (N x N).
+        uniform (bool): Whether the transition matrix is uniform, T = alpha * I + beta * 1. If True,
+            `alpha` and `beta` are used in place of the dense matrices.
+        alpha (float): The diagonal weight of a uniform transition matrix.
+        beta (float): The off-diagonal weight of a uniform transition matrix.
+        skip_constant (bool): Whether to skip samples whose input argmax is the same class at every
+            time step. These samples get a belief of 1 for that class. Only valid when the belief
+            argmax is all that is kept and the transition matrix is uniform with `alpha` > 0.
+        n_steps (int): The number of time steps.
+        n_labels (int): The number of class labels.
+        n_samples (int): The number of samples.
+        out (3d array): The output belief (S x M x N), written in place.
+    """
+
+    for s in prange(n_samples):
+
+        sample_max = 0.
+
+        for t in range(0, n_steps):
+            for k in range(0, n_labels):
+                sample_max = max(sample_max, d_stack[s, t, k])
+
+        if sample_max == 0:
+
+            for t in range(0, n_steps):
+                for k in range(0, n_labels):
+                    out[s, t, k] = 0.
+
+            continue
+
+        if skip_constant:
+
+            constant_label = -1
+            constant = True
+
+            for t in range(0, n_steps):
+
+                label = 0
+
+                for k in range(1, n_labels):
+                    if d_stack[s, t, k] > d_stack[s, t, label]:
+                        label = k
+
+                if t == 0:
+                    constant_label = label
+                elif label != constant_label:
+                    constant = False
+                    break
+
+            if constant:
+
+                for t in range(0, n_steps):
+                    for k in range(0, n_labels):
+                        out[s, t, k] = 0.
+
+                    out[s, t, constant_label] = 1.
+
+                continue
+
+        forward = np.empty((n_steps, n_labels), dtype=np.float32)
+        backward = np.empty((n_steps, n_labels), dtype=np.float32)
+
+        # Compute forward messages
+        for k in range(0, n_labels):
+            forward[0, k] = d_stack[s, 0, k]
+
+        for t in range(1, n_steps):
+
+            Z = 0.
+            f_sum = 0.
+
+            if uniform:
+
+                for j in range(0, n_labels):
+                    f_sum += forward[t-1, j]
+
+            for k in range(0, n_labels):
+
+                if uniform:
+                    acc = alpha * forward[t-1, k] + beta * f_sum
+                else:
+
+                    acc = 0.
+
+                    for j in range(0, n_labels):
+                        acc += transition_matrix_t[k, j] * forward[t-1, j]
+
+                forward[t, k] = d_stack[s, t, k] * acc
+                Z += forward[t, k]
+
+            if Z > 0:
+
+                for k in range(0, n_labels):
+                    forward[t, k] /= Z
+
+        # Compute backward messages
+        for k in range(0, n_labels):
+            backward[n_steps-1, k] = 1.
+
+        for t in range(n_steps-1, 0, -1):
+
+            Z = 0.
+            b_sum = 0.
+
+            if uniform:
+
+                for j in range(0, n_labels):
+                    b_sum += d_stack[s, t, j] * backward[t, j]
+
+            for k in range(0, n_labels):
+
+                if uniform:
+                    acc = alpha * d_stack[s, t, k] * backward[t, k] + beta * b_sum
+                else:
+
+                    acc = 0.
+
+                    for j in range(0, n_labels):
+                        acc += transition_matrix[k, j] * d_stack[s, t, j] * backward[t, j]
+
+                backward[t-1, k] = acc
+                Z += acc
+
+            if Z > 0:
+
+                for k in range(0, n_labels):
+                    backward[t-1, k] /= Z
+
+        # Normalize the belief
+        for t in range(0, n_steps):
+
+            Z = 0.
+
+            for k in range(0, n_labels):
+                Z += forward[t, k] * backward[t, k]
+
+            if Z == 0:
+                Z = 1.
+
+            for k in range(0, n_labels):
+                out[s, t, k] = forward[t, k] * backward[t, k] / Z
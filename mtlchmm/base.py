@@ -16,24 +16,34 @@ class MTLCHMM(ModelHMM):
                  assign_class=False,
                  class_list=None,
                  out_dir=None,
+                 log_domain=False,
+                 quantize=False,
+                 use_gpu=False,
                  **kwargs):
 
         """
         Args:
-            method (Optional[str]): The method to model. Choices are ['forward-backward'].
+            method (Optional[str]): The method to model. Choices are ['forward-backward', 'viterbi'].
+                'viterbi' writes the most likely class series, as with `assign_class`=True.
             transition_prior (Optional[float or 2d array]): The state transition probabilities for
                 class transition from one year to the next. Default is 0.1.
 
                 *If `transition_prior` is a float, the same transition probability applies to each class. If
                     `transition_prior` is a 2d array, the class transitions are treated separately.
 
-            n_jobs (Optional[int]): The number of parallel jobs. Default is 1.
+            n_jobs (Optional[int]): The number of threads used by BLAS and the compiled kernels. Default is 1.
             block_size (Optional[int]): The block size for in-memory processing. Default is 2000.
             assign_class (Optional[bool]): Whether to assign the class value with the maximum probability.
                 Default is False.
             class_list (Optional[int list]): When `assign_class`=True, a list of class values to assign
                 to max probabilities. Default is None, or assign ordered indices.
             out_dir (Optional[str]): The output directory. Default is None, or write to input directory.
+            log_domain (Optional[bool]): Whether to run forward-backward in log space. This is slower,
+                but a time step with all-zero probabilities does not zero the belief of the whole
+                pixel. Default is False.
+            quantize (Optional[bool]): Whether to hold block probabilities in memory as 16-bit integers,
+                which halves the block memory. Each time step is scaled to [0, 65535]. Default is False.
+            use_gpu (Optional[bool]): Whether to run forward-backward on the GPU with CuPy. Default is False.
             kwargs (Optional): Keyword arguments for `mpglue` `create_raster`.
 
         Examples:
@@ -48,9 +58,9 @@ class MTLCHMM(ModelHMM):
             >>>                 class_list=[1, 10, 20])
         """
 
-        if method != 'forward-backward':
+        if method not in ['forward-backward', 'viterbi']:
 
-            logger.error('  The method must be forward-backward.')
+            logger.error('  The method must be forward-backward or viterbi.')
             raise NameError
 
         self.method = method
@@ -60,6 +70,9 @@ class MTLCHMM(ModelHMM):
         self.assign_class = assign_class
         self.class_list = class_list
         self.out_dir = out_dir
+        self.log_domain = log_domain
+        self.quantize = quantize
+        self.use_gpu = use_gpu
         self.kwargs = kwargs
 
         self.lc_probabilities = None
@@ -69,3 +82,15 @@ class MTLCHMM(ModelHMM):
         self.cols = None
         self.methods = None
         self.image_infos = None
+        self.transition_matrix = None
+        self.transition_matrix_t = None
+        self.transition_weights = None
+        self.stack_dtype = None
+
+        self._class_lut = None
+        self._use_kernel = False
+        self._transition_matrices = None
+        self._series = None
+        self._forward = None
+        self._backward = None
+        self._belief = None
@@ -7,12 +7,12 @@ from __future__ import division
 from builtins import int
 
 import os
-import multiprocessing as multi
-import ctypes
+from concurrent.futures import ThreadPoolExecutor
 
 from .errors import logger
 
 from mpglue import raster_tools
+from osgeo import gdal
 
 try:
     import numpy as np
@@ -20,96 +20,349 @@ except ImportError:
     raise ImportError('NumPy must be installed')
 
 try:
-    mkl_rt = ctypes.CDLL('libmkl_rt.so')
-    MKL_INSTALLED = True
-except:
-    MKL_INSTALLED = False
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    raise ImportError('threadpoolctl must be installed')
+
+# The compiled forward-backward kernel. The Cython
+#   extension is preferred over the Numba kernel.
+try:
+    from ._fb_kernel import fb_block, set_threads
+    KERNEL_INSTALLED = True
+except ImportError:
+
+    try:
+        from ._numba_kernels import fb_block, set_threads
+        KERNEL_INSTALLED = True
+    except ImportError:
+        KERNEL_INSTALLED = False
+
+try:
+    import cupy
+    CUPY_INSTALLED = True
+except ImportError:
+    CUPY_INSTALLED = False
+
 
+# Array layout
+#
+#   Block stacks, forward and backward messages, and block results
+#   are all (samples x time steps x class layers), C-contiguous. A
+#   pixel's full time series is one contiguous run, tiles are
+#   contiguous sample ranges, and the class layers are the unit-stride
+#   axis used by the transition products and the normalization. The
+#   compiled kernels read and write the same layout, so keep any new
+#   arrays in this order.
 
-def normalize(v):
+# The cache budget used to size pixel tiles
+#   for the NumPy forward-backward. The floor only
+#   applies to series longer than the budget allows
+#   (e.g., T * K > 1365 with 64 samples), where the
+#   per-call overhead of smaller tiles would dominate.
+L2_CACHE_BYTES = 1048576
+MIN_TILE_SIZE = 64
+
+# The smallest normal float32, used as the normalization floor
+#   so that all-zero rows are divided without branching.
+TINY = np.finfo('float32').tiny
+
+# The probability floor applied before taking logs.
+LOG_FLOOR = 1e-30
+
+# The integer range of quantized block probabilities.
+QUANT_MAX = 65535
+
+# The number of samples per tile on the GPU.
+GPU_TILE_SIZE = 131072
+
+# The number of samples per compiled kernel call when
+#   only the class with the maximum belief is kept.
+KERNEL_TILE_SIZE = 65536
+
+
+def get_array_module(a):
 
     """
-    Normalizes a probability vector by dividing each element by the
-    sum of the elements. The elements are probabilities, which are
-    assumed to be in the range [0, 1]. Returns v unmodified if the sum
-    is <= 0.0.
+    Returns the array module (NumPy or CuPy) of an array
+
+    Args:
+        a (ndarray): The array.
     """
 
-    Z = v.sum()
+    if CUPY_INSTALLED:
+        return cupy.get_array_module(a)
 
-    if Z > 0:
-        return v / Z
+    return np
 
-    return v
 
+def tile_size(n_steps, n_labels):
 
-def forward_backward(n_sample):
+    """
+    Returns the number of samples to process per tile so that the
+    time series, forward, and backward messages fit in the L2 cache,
+    with a floor of `MIN_TILE_SIZE` samples for very long series.
 
+    Args:
+        n_steps (int): The number of time steps.
+        n_labels (int): The number of class labels.
     """
-    Uses the Forward/Backward algorithm to compute marginal probabilities by
-    propagating influence forward along the chain.
+
+    return max(MIN_TILE_SIZE, L2_CACHE_BYTES // (n_steps * n_labels * 4 * 3))
+
+
+def transition_dot(x, transition_matrix, transition_weights, out):
+
+    """
+    Multiplies each row of `x` by the transition matrix.
 
     Args:
-        n_sample (int)
+        x (2d array): A 2d array (S x N), where S = samples and N = class labels.
+        transition_matrix (2d array): The state transition matrix (N x N).
+        transition_weights (tuple): The (diagonal, off-diagonal) weights of a uniform transition
+            matrix, T = diagonal * I + off-diagonal * 1, or None to use the dense `transition_matrix`.
+        out (2d array): The (S x N) output array. It must not overlap `x`.
+    """
+
+    xp = get_array_module(x)
+
+    if transition_weights is None:
+        return xp.matmul(x, transition_matrix, out=out)
+
+    # A uniform transition matrix is a scaled identity plus a
+    #   constant, so the product only needs the row sums.
+    alpha, beta = transition_weights
+
+    xp.multiply(x, alpha, out=out)
+    out += beta * x.sum(axis=1, keepdims=True)
+
+    return out
+
+
+def forward_backward(time_series,
+                     transition_matrix,
+                     transition_matrix_t,
+                     transition_weights=None,
+                     forward=None,
+                     backward=None):
+
+    """
+    Uses the Forward/Backward algorithm to compute marginal probabilities by
+    propagating influence forward along the chain. All samples in a block
+    are processed at once, so each time step is a single (S x N) x (N x N)
+    matrix product.
 
-    time_series (2d array): A 2d array (M x N), where M = time steps and N = class labels.
-        Each row represents one time step.
+    Args:
+        time_series (3d array): A 3d array (S x M x N), where S = samples, M = time steps,
+            and N = class labels.
+        transition_matrix (2d array): The state transition matrix (N x N).
+        transition_matrix_t (2d array): The transposed state transition matrix (N x N).
+        transition_weights (Optional[tuple]): The (diagonal, off-diagonal) weights of a uniform
+            transition matrix. Default is None, or use the dense transition matrices.
+        forward (Optional[3d array]): A (S x M x N) scratch array for the forward messages. The
+            belief is written to `forward`. Default is None, or allocate a new array.
+        backward (Optional[3d array]): A (S x M x N) scratch array for the backward messages.
+            Default is None, or allocate a new array.
+
+    Returns:
+        The belief as a 3d array (S x M x N).
 
     Reference:
         For background on this algorithm see Section 17.4.2 of
         'Machine Learning: A Probabilistic Perspective' by Kevin Murphy.
     """
 
+    xp = get_array_module(time_series)
+
     # TODO: implement a user mask
     # lw_mask = time_series[0]
     # if lw_mask == 1:
     #     WATER_PROB_VECTOR
 
-    time_series = d_stack[n_sample::n_samples].reshape(n_steps, n_labels)
+    n_samples, n_steps, n_labels = time_series.shape
+
+    if forward is None:
+        forward = xp.empty((n_samples, n_steps, n_labels), dtype='float32')
+
+    if backward is None:
+        backward = xp.empty((n_samples, n_steps, n_labels), dtype='float32')
+
+    # Compute forward messages
+    forward[:, 0] = time_series[:, 0]
+
+    for t in range(1, n_steps):
+
+        transition_dot(forward[:, t-1], transition_matrix, transition_weights, forward[:, t])
+        forward[:, t] *= time_series[:, t]
+
+        # Normalize
+        Z = forward[:, t].sum(axis=1, keepdims=True)
+        xp.divide(forward[:, t], xp.maximum(Z, TINY, out=Z), out=forward[:, t])
+
+    # Compute backward messages
+    backward[:, n_steps-1] = 1.
+
+    for t in range(n_steps-1, 0, -1):
+
+        transition_dot(time_series[:, t] * backward[:, t], transition_matrix_t, transition_weights, backward[:, t-1])
+
+        # Normalize
+        Z = backward[:, t-1].sum(axis=1, keepdims=True)
+        xp.divide(backward[:, t-1], xp.maximum(Z, TINY, out=Z), out=backward[:, t-1])
+
+    belief = xp.multiply(forward, backward, out=forward)
+    Z = belief.sum(axis=2, keepdims=True)
+
+    # Normalize, ignoring zero entries
+    belief /= xp.maximum(Z, TINY, out=Z)
+
+    return belief
+
+
+def logsumexp(a, axis):
+
+    """
+    Computes log(sum(exp(a))) along an axis without overflow.
+
+    Args:
+        a (ndarray): The log values.
+        axis (int): The axis to reduce.
+    """
+
+    xp = get_array_module(a)
+
+    a_max = a.max(axis=axis, keepdims=True)
+
+    return xp.log(xp.exp(a - a_max).sum(axis=axis)) + a_max.squeeze(axis)
+
+
+def forward_backward_log(time_series, transition_matrix, forward=None, backward=None):
+
+    """
+    Uses the Forward/Backward algorithm in log space. Probabilities are floored
+    at `LOG_FLOOR`, so a time step with all-zero probabilities is treated as
+    uninformative rather than zeroing the belief of the whole sample.
+
+    Args:
+        time_series (3d array): A 3d array (S x M x N), where S = samples, M = time steps,
+            and N = class labels.
+        transition_matrix (2d array): The state transition matrix (N x N).
+        forward (Optional[3d array]): A (S x M x N) scratch array for the forward messages. The
+            belief is written to `forward`. Default is None, or allocate a new array.
+        backward (Optional[3d array]): A (S x M x N) scratch array for the backward messages.
+            Default is None, or allocate a new array.
+
+    Returns:
+        The belief as a 3d array (S x M x N).
+    """
+
+    xp = get_array_module(time_series)
+
+    n_samples, n_steps, n_labels = time_series.shape
 
-    if time_series.max() == 0:
-        return time_series.T
+    if forward is None:
+        forward = xp.empty((n_samples, n_steps, n_labels), dtype='float32')
+
+    if backward is None:
+        backward = xp.empty((n_samples, n_steps, n_labels), dtype='float32')
+
+    log_v = xp.log(xp.maximum(time_series, LOG_FLOOR))
+    log_t = xp.log(xp.maximum(transition_matrix, LOG_FLOOR)).astype('float32')
 
     # Compute forward messages
-    forward[0, :] = time_series[0, :]
+    forward[:, 0] = log_v[:, 0]
 
     for t in range(1, n_steps):
 
-        v = np.multiply(time_series[t, :], transition_matrix_t.dot(forward[t-1, :]))
-        forward[t, :] = normalize(v)
+        # log(sum_j f[j] * T[j, k])
+        forward[:, t] = log_v[:, t] + logsumexp(forward[:, t-1][:, :, np.newaxis] + log_t, axis=1)
+
+        # Normalize
+        forward[:, t] -= logsumexp(forward[:, t], axis=1)[:, np.newaxis]
 
     # Compute backward messages
-    backward[n_steps-1, :] = label_ones
+    backward[:, n_steps-1] = 0.
 
     for t in range(n_steps-1, 0, -1):
 
-        v = np.dot(transition_matrix, np.multiply(time_series[t, :], backward[t, :]))
-        backward[t-1, :] = normalize(v)
+        # log(sum_j T[k, j] * v[j] * b[j])
+        backward[:, t-1] = logsumexp((log_v[:, t] + backward[:, t])[:, np.newaxis, :] + log_t, axis=2)
+
+        # Normalize
+        backward[:, t-1] -= logsumexp(backward[:, t-1], axis=1)[:, np.newaxis]
 
-    belief = np.multiply(forward, backward)
-    Z = belief.sum(axis=1)
+    belief = xp.add(forward, backward, out=forward)
+    belief -= logsumexp(belief, axis=2)[:, :, np.newaxis]
 
-    # Ignore zero entries
-    Z[Z == 0] = 1.
+    xp.exp(belief, out=belief)
 
-    # Normalize
-    belief /= Z.reshape((n_steps, 1))
+    # Samples without data have no belief.
+    belief[time_series.max(axis=(1, 2)) == 0] = 0.
 
-    # Return belief as flattened vector
-    # d_stack[n_sample::n_samples] = belief.ravel()
+    return belief
 
-    return belief.T
 
+def index_dtype(n_labels):
 
-# TODO
-def viterbi():
+    """
+    Returns the smallest unsigned integer type that holds a class index
+
+    Args:
+        n_labels (int): The number of class labels.
+    """
+
+    return 'uint8' if n_labels <= 256 else 'uint16'
+
+
+def viterbi(time_series, transition_matrix):
 
     """
     Use the Viterbi algorithm to determine the most likely series
-    of states from a time series.
+    of states from a time series. All samples are processed at once
+    in log space.
+
+    Args:
+        time_series (3d array): A 3d array (S x M x N), where S = samples, M = time steps,
+            and N = class labels.
+        transition_matrix (2d array): The state transition matrix (N x N).
+
+    Returns:
+        The most likely class index at each time step as a 2d array (S x M).
     """
 
-    return
+    xp = get_array_module(time_series)
+
+    n_samples, n_steps, n_labels = time_series.shape
+
+    log_v = xp.log(xp.maximum(time_series, LOG_FLOOR))
+    log_t = xp.log(xp.maximum(transition_matrix, LOG_FLOOR)).astype('float32')
+
+    # The best previous class for each class and time step
+    psi = xp.empty((n_samples, n_steps, n_labels), dtype=index_dtype(n_labels))
+
+    delta = log_v[:, 0]
+
+    for t in range(1, n_steps):
+
+        # delta[j] + log(T[j, k])
+        scores = delta[:, :, np.newaxis] + log_t
+
+        psi[:, t] = scores.argmax(axis=1)
+
+        delta = log_v[:, t] + scores.max(axis=1)
+
+        # Keep the scores bounded
+        delta -= delta.max(axis=1, keepdims=True)
+
+    # Backtrack
+    path = xp.empty((n_samples, n_steps), dtype=index_dtype(n_labels))
+    path[:, n_steps-1] = delta.argmax(axis=1)
+
+    sample_index = xp.arange(0, n_samples)
+
+    for t in range(n_steps-1, 0, -1):
+        path[:, t-1] = psi[sample_index, t, path[:, t]]
+
+    return path
 
 
 class ModelHMM(object):
@@ -132,8 +385,13 @@ class ModelHMM(object):
             logger.error('The `fit` method cannot be executed without data.')
             raise ValueError
 
-        if MKL_INSTALLED:
-            n_threads_ = mkl_rt.MKL_Set_Num_Threads(self.n_jobs)
+        if self.use_gpu and not CUPY_INSTALLED:
+
+            logger.error('CuPy must be installed to use the GPU.')
+            raise ImportError
+
+        if KERNEL_INSTALLED:
+            set_threads(self.n_jobs)
 
         self.lc_probabilities = lc_probabilities
         self.n_steps = len(self.lc_probabilities)
@@ -165,16 +423,40 @@ class ModelHMM(object):
         # Setup the transition matrix.
         self._transition_matrix()
 
-        self.methods = {'forward-backward': forward_backward,
+        self.stack_dtype = 'uint16' if self.quantize else 'float32'
+
+        # The class value of each class index
+        if isinstance(self.class_list, list):
+            self._class_lut = np.asarray(self.class_list, dtype='uint8')
+        else:
+            self._class_lut = np.arange(0, self.n_labels, dtype='uint8')
+
+        self.methods = {'forward-backward': forward_backward_log if self.log_domain else forward_backward,
                         'viterbi': viterbi}
 
+        if KERNEL_INSTALLED and (self.method == 'forward-backward') and not self.log_domain and not self.use_gpu:
+
+            # Compile the kernel before
+            #   processing any blocks.
+            fb_block(np.zeros((1, self.n_steps, self.n_labels), dtype=self.stack_dtype),
+                     self.transition_matrix,
+                     self.transition_matrix_t,
+                     *self._kernel_args(),
+                     self.n_steps,
+                     self.n_labels,
+                     1,
+                     np.empty((1, self.n_steps, self.n_labels), dtype='float32'))
+
         # Open the images.
         self.image_infos = [raster_tools.ropen(image) for image in self.lc_probabilities]
 
         self._setup_out_infos(**self.kwargs)
 
-        # Iterate over the image block by block.
-        self._block_func()
+        # Iterate over the image block by block,
+        #   limiting BLAS (MKL, OpenBLAS, or BLIS)
+        #   to `n_jobs` threads.
+        with threadpool_limits(limits=self.n_jobs, user_api='blas'):
+            self._block_func()
 
     def _setup_out_infos(self, **kwargs):
 
@@ -211,7 +493,7 @@ class ModelHMM(object):
 
                 o_info = image_info.copy()
 
-                if self.assign_class:
+                if self.assign_class or (self.method == 'viterbi'):
 
                     o_info.update_info(storage='byte',
                                        bands=1)
@@ -222,17 +504,49 @@ class ModelHMM(object):
 
     def _block_func(self):
 
-        global d_stack, forward, backward, label_ones, n_samples, n_steps, n_labels
+        self._use_kernel = KERNEL_INSTALLED and \
+                          (self.method == 'forward-backward') and \
+                          not self.log_domain and \
+                          not self.use_gpu
+
+        if not self._use_kernel:
+
+            if self.use_gpu:
+
+                xp = cupy
+                n_tile = GPU_TILE_SIZE
 
-        n_steps = self.n_steps
-        n_labels = self.n_labels
+                self._transition_matrices = (cupy.asarray(self.transition_matrix),
+                                             cupy.asarray(self.transition_matrix_t))
 
-        if self.method == 'forward-backward':
+            else:
+
+                xp = np
+                n_tile = tile_size(self.n_steps, self.n_labels)
+
+                self._transition_matrices = (self.transition_matrix,
+                                             self.transition_matrix_t)
+
+            n_tile = min(n_tile, self.block_size * self.block_size)
+
+            # On the CPU, the forward messages (and the belief) of a
+            #   tile with no skipped samples are written directly to
+            #   the block results.
+            self._series = xp.empty((n_tile, self.n_steps, self.n_labels), dtype='float32')
+            self._forward = xp.empty((n_tile, self.n_steps, self.n_labels), dtype='float32')
+            self._backward = xp.empty((n_tile, self.n_steps, self.n_labels), dtype='float32')
 
-            forward = np.empty((self.n_steps, self.n_labels), dtype='float32')
-            backward = np.empty((self.n_steps, self.n_labels), dtype='float32')
+        if self.assign_class:
 
-            label_ones = np.ones(self.n_labels, dtype='float32')
+            # The belief of one tile, reduced to class indices
+            #   before it is stored in the block results.
+            n_tile = KERNEL_TILE_SIZE if self._use_kernel else self._series.shape[0]
+
+            self._belief = np.empty((min(n_tile, self.block_size * self.block_size),
+                                     self.n_steps,
+                                     self.n_labels), dtype='float32')
+
+        blocks = list()
 
         for i in range(0, self.rows, self.block_size):
 
@@ -247,123 +561,476 @@ class ModelHMM(object):
 
                 n_cols = raster_tools.n_rows_cols(j, self.block_size, self.cols)
 
-                # Total samples in the block.
-                n_samples = n_rows * n_cols
+                blocks.append((i, j, n_rows, n_cols, hmm_block_tracker))
 
-                # Setup the block stack.
-                # time steps x class layers x rows x columns
-                d_stack = np.empty((self.n_steps, self.n_labels, n_rows, n_cols), dtype='float32')
+        # Allocate the block arrays once at the largest block
+        #   size. Each block uses a view of the first n_samples.
+        #   There are two of each because the next block is read,
+        #   and the previous block written, while the current
+        #   block is processed.
+        max_samples = min(self.block_size, self.rows) * min(self.block_size, self.cols)
 
-                block_max = 0
+        stack_buffers = [np.empty((max_samples, self.n_steps, self.n_labels), dtype=self.stack_dtype)
+                         for __ in range(0, 2)]
 
-                # Load the block stack.
-                #   *all time steps + all probability layers @ 1 pixel = d_stack[:, :, 0, 0]
-                for step in range(0, self.n_steps):
+        if self.assign_class or (self.method == 'viterbi'):
 
-                    step_array = self.image_infos[step].read(bands2open=self.n_jobs,
-                                                             i=i,
-                                                             j=j,
-                                                             rows=n_rows,
-                                                             cols=n_cols,
-                                                             d_type='float32')
+            result_buffers = [np.empty((max_samples, self.n_steps), dtype=index_dtype(self.n_labels))
+                              for __ in range(0, 2)]
+
+        else:
 
-                    # step_array /= step_array.max(axis=0)
+            result_buffers = [np.empty((max_samples, self.n_steps, self.n_labels), dtype='float32')
+                              for __ in range(0, 2)]
 
-                    step_array[np.isnan(step_array) | np.isinf(step_array)] = 0
+        # The number of processed blocks
+        n_processed = 0
 
-                    block_max = max(block_max, step_array.max())
+        # Read the next block and write the previous
+        #   block in the background while the current
+        #   block is processed.
+        with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
 
-                    d_stack[step] = step_array
+            write_future = None
 
-                if block_max == 0:
+            if blocks:
+                read_future = reader.submit(self._load_block, *blocks[0][:4], out=stack_buffers[0])
+
+            for bi, (i, j, n_rows, n_cols, hmm_block_tracker) in enumerate(blocks):
+
+                d_stack = read_future.result()
+
+                if bi + 1 < len(blocks):
+
+                    read_future = reader.submit(self._load_block,
+                                                *blocks[bi+1][:4],
+                                                out=stack_buffers[(bi+1) % 2])
+
+                if d_stack is None:
                     continue
 
-                d_stack = d_stack.ravel()
+                hmm_results = self._predict_block(d_stack, out=result_buffers[n_processed % 2])
 
-                # Process each pixel, getting 1
-                #   pixel for all time steps.
-                #
-                # Reshape data to a NxK matrix,
-                #   where N is number of time steps and
-                #   K is the number of labels.
-                #
-                # Therefore, each row represents one time step.
-                pool = multi.Pool(processes=self.n_jobs)
-                hmm_results = pool.map(self.methods[self.method], range(0, n_samples))
-                pool.close()
-                pool = None
+                n_processed += 1
 
-                # Parallel(n_jobs=self.n_jobs,
-                #          max_nbytes=None)(delayed(self.methods[self.method])(n_sample,
-                #                                                              n_samples,
-                #                                                              self.n_steps,
-                #                                                              self.n_labels)
-                #                           for n_sample in range(0, n_samples))
+                # Only one block waits to be written at a time.
+                if write_future is not None:
+                    write_future.result()
 
-                hmm_results = np.asarray(hmm_results,
-                                         dtype='float32').T.reshape(self.n_steps,
-                                                                    self.n_labels,
-                                                                    n_rows,
-                                                                    n_cols)
+                write_future = writer.submit(self._write_block,
+                                             hmm_results,
+                                             i,
+                                             j,
+                                             n_rows,
+                                             n_cols,
+                                             hmm_block_tracker)
 
-                # Reshape the results.
-                # d_stack = d_stack.reshape(self.n_steps, self.n_labels, n_rows, n_cols)
+            if write_future is not None:
+                write_future.result()
 
-                # Write the block results to file.
+        self.close()
 
-                # Iterate over each time step.
-                for step in range(0, self.n_steps):
+    def _load_block(self, i, j, n_rows, n_cols, out=None):
 
-                    # Get the image for the
-                    #   current time step.
-                    out_rst = self.o_infos[step]
+        """
+        Loads a block of all time steps
 
-                    # Get the array for the
-                    #   current time step.
-                    hmm_sub = hmm_results[step]
+        Args:
+            i (int): The starting row.
+            j (int): The starting column.
+            n_rows (int): The number of block rows.
+            n_cols (int): The number of block columns.
+            out (Optional[3d array]): A buffer to hold the block stack, with at least
+                `n_rows` x `n_cols` samples. Default is None, or allocate a new array.
+
+        Returns:
+            The block stack as a 3d array (samples x time steps x class layers),
+            or None if the block has no data.
+        """
 
-                    if self.assign_class:
+        # Total samples in the block.
+        n_samples = n_rows * n_cols
 
-                        probabilities_argmax = hmm_sub.argmax(axis=0)
+        # Setup the block stack.
+        # samples x time steps x class layers
+        if out is None:
+            d_stack = np.empty((n_samples, self.n_steps, self.n_labels), dtype=self.stack_dtype)
+        else:
+            d_stack = out[:n_samples]
+
+        block_max = 0
 
-                        if isinstance(self.class_list, list):
+        # Load the block stack.
+        #   *all time steps + all probability layers @ 1 pixel = d_stack[0]
+        for step in range(0, self.n_steps):
 
-                            predictions = np.zeros(probabilities_argmax.shape, dtype='uint8')
+            step_array = self.image_infos[step].read(bands2open=-1,
+                                                     i=i,
+                                                     j=j,
+                                                     rows=n_rows,
+                                                     cols=n_cols,
+                                                     d_type='float32')
 
-                            for class_index, real_class in enumerate(self.class_list):
-                                predictions[probabilities_argmax == class_index] = real_class
+            # step_array /= step_array.max(axis=0)
 
-                        else:
-                            predictions = probabilities_argmax
+            step_array[np.isnan(step_array) | np.isinf(step_array)] = 0
 
-                        out_rst.write_array(predictions,
-                                            i=i,
-                                            j=j,
-                                            band=1)
+            # class layers x samples -> samples x class layers
+            step_array = step_array.reshape(self.n_labels, n_samples).T
 
-                        out_rst.close_band()
+            step_max = step_array.max()
 
-                    else:
+            block_max = max(block_max, step_max)
 
-                        # Iterate over each probability layer.
-                        for layer in range(0, self.n_labels):
+            if self.quantize:
 
-                            # Write the block for the
-                            #   current probability layer.
-                            out_rst.write_array(hmm_sub[layer],
-                                                i=i,
-                                                j=j,
-                                                band=layer+1)
+                # Scale each time step to the integer range. The
+                #   scale cancels when the messages are normalized.
+                if step_max > 0:
+                    d_stack[:, step] = np.rint(step_array * (QUANT_MAX / step_max))
+                else:
+                    d_stack[:, step] = 0
 
-                            out_rst.close_band()
+            else:
+                d_stack[:, step] = step_array
 
-                with open(hmm_block_tracker, 'wb') as btxt:
-                    btxt.write('complete')
+        if block_max == 0:
+            return None
 
-        self.close()
+        return d_stack
+
+    def _predict_block(self, d_stack, out=None):
+
+        """
+        Runs the model over a block stack
+
+        Args:
+            d_stack (3d array): The block stack (samples x time steps x class layers).
+            out (Optional[2d or 3d array]): A buffer to hold the results, with at least as many
+                samples as `d_stack`. It is 2d (samples x time steps) with `assign_class` or
+                method='viterbi', and 3d (samples x time steps x class layers) otherwise.
+                Default is None, or allocate a new array.
+
+        Returns:
+            With `assign_class`, the class index with the maximum belief as a 2d array
+            (samples x time steps). With method='viterbi', the most likely class index
+            path from `_viterbi` as a 2d array (samples x time steps). Otherwise, the belief
+            as a 3d array (samples x time steps x class layers).
+        """
+
+        if self.method == 'viterbi':
+            return self._viterbi(d_stack, out=out)
+
+        n_samples = d_stack.shape[0]
+
+        # Only the class index is kept when assigning classes.
+        if self.assign_class:
+
+            result_shape = (self.n_steps,)
+            result_dtype = index_dtype(self.n_labels)
+            model_func = self._forward_backward_argmax
+
+        else:
+
+            result_shape = (self.n_steps, self.n_labels)
+            result_dtype = 'float32'
+            model_func = self._forward_backward
+
+        if out is None:
+            hmm_results = np.empty((n_samples,) + result_shape, dtype=result_dtype)
+        else:
+            hmm_results = out[:n_samples]
+
+        # Empty and constant-class samples are skipped
+        #   per tile, or by the compiled kernels.
+        return model_func(d_stack, hmm_results)
+
+    def _forward_backward_argmax(self, d_stack, hmm_results):
+
+        """
+        Runs forward-backward over a stack, keeping only the class index with
+        the maximum belief
+
+        Args:
+            d_stack (3d array): The stack (samples x time steps x class layers).
+            hmm_results (2d array): The output class indices (samples x time steps).
+
+        Returns:
+            `hmm_results`
+        """
+
+        n_samples = d_stack.shape[0]
+        n_tile = self._belief.shape[0]
+
+        # The compiled kernels skip constant-class samples themselves.
+        skip_constant = self._skip_constant() and not self._use_kernel
+
+        constant = None
+
+        for p in range(0, n_samples, n_tile):
+
+            n_sub = min(n_tile, n_samples - p)
+
+            if skip_constant:
+
+                labels = d_stack[p:p+n_sub].argmax(axis=2)
+                constant = (labels == labels[:, :1]).all(axis=1)
+
+            belief = self._forward_backward(d_stack[p:p+n_sub], self._belief[:n_sub], skip=constant)
+
+            hmm_results[p:p+n_sub] = belief.argmax(axis=2)
+
+            if skip_constant:
+                hmm_results[p:p+n_sub][constant] = labels[constant]
+
+        return hmm_results
+
+    def _forward_backward(self, d_stack, hmm_results, skip=None):
+
+        """
+        Runs forward-backward over a stack
+
+        Args:
+            d_stack (3d array): The stack (samples x time steps x class layers).
+            hmm_results (3d array): The output belief (samples x time steps x class layers).
+            skip (Optional[1d array]): A boolean mask of samples to skip, with a belief of 0. Empty
+                samples are always skipped. Default is None. Not used by the compiled kernels.
+
+        Returns:
+            `hmm_results`
+        """
+
+        n_samples = d_stack.shape[0]
+
+        if self._use_kernel:
+
+            fb_block(d_stack,
+                     self.transition_matrix,
+                     self.transition_matrix_t,
+                     *self._kernel_args(),
+                     self.n_steps,
+                     self.n_labels,
+                     n_samples,
+                     hmm_results)
+
+            return hmm_results
+
+        n_tile = self._series.shape[0]
+
+        transition_matrix, transition_matrix_t = self._transition_matrices
+
+        # Process the samples in tiles,
+        #   reusing the message arrays.
+        for p in range(0, n_samples, n_tile):
+
+            n_sub = min(n_tile, n_samples - p)
+
+            results = hmm_results[p:p+n_sub]
+
+            # Samples with data
+            run = d_stack[p:p+n_sub].max(axis=(1, 2)) > 0
+
+            if skip is not None:
+                run &= ~skip[p:p+n_sub]
+
+            n_run = int(run.sum())
+
+            if n_run == 0:
+
+                results[...] = 0.
+                continue
+
+            if n_run < n_sub:
+
+                # Gather the samples to run into the tile scratch.
+                results[~run] = 0.
+                series = self._tile_series(d_stack, p, n_sub, index=run)
+
+            else:
+
+                run = None
+                series = self._tile_series(d_stack, p, n_sub)
+
+            backward = self._backward[:n_run]
+
+            if self.use_gpu or (run is not None):
+                forward = self._forward[:n_run]
+            else:
+                forward = results
+
+            if self.log_domain:
+
+                belief = self.methods[self.method](series,
+                                                   transition_matrix,
+                                                   forward=forward,
+                                                   backward=backward)
+
+            else:
+
+                belief = self.methods[self.method](series,
+                                                   transition_matrix,
+                                                   transition_matrix_t,
+                                                   transition_weights=self.transition_weights,
+                                                   forward=forward,
+                                                   backward=backward)
+
+            if self.use_gpu:
+                belief = cupy.asnumpy(belief)
+
+            if run is not None:
+                results[run] = belief
+            elif self.use_gpu:
+                results[...] = belief
+
+        return hmm_results
+
+    def _viterbi(self, d_stack, out=None):
+
+        """
+        Runs the Viterbi algorithm over a block stack
+
+        Args:
+            d_stack (3d array): The block stack (samples x time steps x class layers).
+            out (Optional[2d array]): A buffer to hold the class indices, with at least as many
+                samples as `d_stack`. Default is None, or allocate a new array.
+
+        Returns:
+            The most likely class index at each time step as a 2d array (samples x time steps).
+        """
+
+        n_samples = d_stack.shape[0]
+
+        if out is None:
+            path = np.empty((n_samples, self.n_steps), dtype=index_dtype(self.n_labels))
+        else:
+            path = out[:n_samples]
+
+        n_tile = self._series.shape[0]
+
+        transition_matrix = self._transition_matrices[0]
+
+        for p in range(0, n_samples, n_tile):
+
+            n_sub = min(n_tile, n_samples - p)
+
+            path_sub = self.methods[self.method](self._tile_series(d_stack, p, n_sub),
+                                                 transition_matrix)
+
+            if self.use_gpu:
+                path_sub = cupy.asnumpy(path_sub)
+
+            path[p:p+n_sub] = path_sub
+
+        return path
+
+    def _tile_series(self, d_stack, p, n_sub, index=None):
+
+        """
+        Returns a float32 tile of a block stack, on the GPU if `use_gpu` is True
+
+        Args:
+            d_stack (3d array): The block stack (samples x time steps x class layers).
+            p (int): The first sample of the tile.
+            n_sub (int): The number of samples in the tile.
+            index (Optional[1d array]): A boolean mask of tile samples to gather into the
+                tile scratch. Default is None, or use all samples of the tile.
+        """
+
+        tile = d_stack[p:p+n_sub]
+
+        if index is not None:
+
+            n_sub = int(index.sum())
+            series = self._series[:n_sub]
+
+            if self.use_gpu:
+
+                series[...] = cupy.asarray(np.compress(index, tile, axis=0))
+
+                if self.quantize:
+                    series *= 1.0 / QUANT_MAX
+
+            elif self.quantize:
+                np.multiply(np.compress(index, tile, axis=0), np.float32(1.0 / QUANT_MAX), out=series)
+            else:
+                np.compress(index, tile, axis=0, out=series)
+
+        elif self.use_gpu:
+
+            series = self._series[:n_sub]
+            series[...] = cupy.asarray(tile)
+
+            if self.quantize:
+                series *= 1.0 / QUANT_MAX
+
+        elif self.quantize:
+
+            series = self._series[:n_sub]
+
+            np.multiply(tile, np.float32(1.0 / QUANT_MAX), out=series)
+
+        else:
+            series = tile
+
+        return series
+
+    def _write_block(self, hmm_results, i, j, n_rows, n_cols, hmm_block_tracker):
+
+        """
+        Writes the block results to file
+
+        Args:
+            hmm_results (2d or 3d array): The belief (samples x time steps x class layers), or
+                the class indices (samples x time steps) when assigning classes.
+            i (int): The starting row.
+            j (int): The starting column.
+            n_rows (int): The number of block rows.
+            n_cols (int): The number of block columns.
+            hmm_block_tracker (str): The block tracker file, written after the block is complete.
+        """
+
+        # Iterate over each time step.
+        for step in range(0, self.n_steps):
+
+            # Get the image for the
+            #   current time step.
+            out_rst = self.o_infos[step]
+
+            if self.assign_class or (self.method == 'viterbi'):
+
+                # Map the class indices to class values in one pass.
+                predictions = self._class_lut[hmm_results[:, step].reshape(n_rows, n_cols)]
+
+                out_rst.write_array(predictions,
+                                    i=i,
+                                    j=j,
+                                    band=1)
+
+                out_rst.close_band()
+
+            else:
+
+                # Get the array for the
+                #   current time step.
+                #   samples x class layers -> class layers x rows x columns
+                hmm_sub = hmm_results[:, step].T.tobytes()
+
+                # Write all probability layers in one call.
+                out_rst.datasource.WriteRaster(j,
+                                               i,
+                                               n_cols,
+                                               n_rows,
+                                               hmm_sub,
+                                               buf_xsize=n_cols,
+                                               buf_ysize=n_rows,
+                                               buf_type=gdal.GDT_Float32,
+                                               band_list=list(range(1, self.n_labels+1)))
 
         out_rst = None
 
+        with open(hmm_block_tracker, 'wb') as btxt:
+            btxt.write('complete')
+
     def close(self):
 
         for i_info in self.image_infos:
@@ -386,14 +1053,47 @@ class ModelHMM(object):
         Constructs the transition matrix
         """
 
-        global transition_matrix, transition_matrix_t
-
         if isinstance(self.transition_prior, np.ndarray):
-            transition_matrix = self.transition_prior
+
+            self.transition_matrix = self.transition_prior
+            self.transition_weights = None
+
         else:
 
-            transition_matrix = np.empty((self.n_labels, self.n_labels), dtype='float32')
-            transition_matrix.fill(self.transition_prior)
-            np.fill_diagonal(transition_matrix, 1.0 - self.transition_prior)
+            self.transition_matrix = np.empty((self.n_labels, self.n_labels), dtype='float32')
+            self.transition_matrix.fill(self.transition_prior)
+            np.fill_diagonal(self.transition_matrix, 1.0 - self.transition_prior)
+
+            # The (diagonal, off-diagonal) weights of
+            #   T = (1 - 2p) * I + p * 1
+            self.transition_weights = (np.float32(1.0 - self.transition_prior - self.transition_prior),
+                                       np.float32(self.transition_prior))
+
+        # A contiguous copy rather than a view, for BLAS
+        #   and the compiled kernels.
+        self.transition_matrix_t = np.ascontiguousarray(self.transition_matrix.T)
+
+    def _skip_constant(self):
+
+        """
+        Returns whether samples whose input argmax never changes can be skipped
+
+        With a uniform transition matrix that favors staying in
+        the same class, the belief argmax of such a sample is that
+        same class. Only the class is written with `assign_class`.
+        """
+
+        return self.assign_class and \
+               (self.transition_weights is not None) and \
+               (self.transition_weights[0] > 0)
+
+    def _kernel_args(self):
+
+        """
+        Returns the uniform transition weights and the constant-class skip as compiled kernel arguments
+        """
+
+        if self.transition_weights is None:
+            return False, 0., 0., False
 
-        transition_matrix_t = transition_matrix.T
+        return (True,) + self.transition_weights + (self._skip_constant(),)
@@ -4,8 +4,14 @@ import platform
 
 try:
     from Cython.Distutils import build_ext
+    from Cython.Build import cythonize
+    CYTHON_INSTALLED = True
 except:
     from distutils.command import build_ext
+    CYTHON_INSTALLED = False
+
+from distutils import log
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
 
 import numpy as np
 
@@ -28,7 +34,8 @@ with open('AUTHORS.txt') as f:
     author_file = f.read()
 
 required_packages = ['joblib>=0.11.0',
-                     'numpy>=1.13']
+                     'numpy>=1.13',
+                     'threadpoolctl>=1.0.0']
 
 
 def get_packages():
@@ -39,6 +46,55 @@ def get_package_data():
     return {'': ['*.md', '*.txt']}
 
 
+def get_extensions():
+
+    # The compiled forward-backward kernel is optional. Without
+    #   Cython, the Numba or NumPy paths are used instead.
+    if not CYTHON_INSTALLED:
+        return []
+
+    if platform.system() != 'Windows':
+
+        compile_args = ['-O3', '-ffast-math', '-fopenmp']
+        link_args = ['-fopenmp']
+
+    else:
+
+        compile_args = ['/O2', '/openmp']
+        link_args = []
+
+    return cythonize([setuptools.Extension('mtlchmm._fb_kernel',
+                                           ['mtlchmm/_fb_kernel.pyx'],
+                                           extra_compile_args=compile_args,
+                                           extra_link_args=link_args)])
+
+
+def get_cmdclass():
+
+    if not CYTHON_INSTALLED:
+        return dict(build_ext=build_ext)
+
+    class OptionalBuildExt(build_ext):
+
+        # A failed compile (e.g., no OpenMP support) should not fail
+        #   the install. The kernel import is optional in mtlchmm.model.
+        def run(self):
+
+            try:
+                build_ext.run(self)
+            except (CCompilerError, DistutilsExecError, DistutilsPlatformError) as e:
+                log.warn('The compiled kernel could not be built ({}). Falling back to Numba or NumPy.'.format(e))
+
+        def build_extension(self, ext):
+
+            try:
+                build_ext.build_extension(self, ext)
+            except (CCompilerError, DistutilsExecError, DistutilsPlatformError, ValueError) as e:
+                log.warn('{} could not be built ({}). Falling back to Numba or NumPy.'.format(ext.name, e))
+
+    return dict(build_ext=OptionalBuildExt)
+
+
 def setup_package():
 
     if platform.system() != 'Windows':
@@ -56,7 +112,8 @@ def setup_package():
                     author=author_file,
                     packages=get_packages(),
                     package_data=get_package_data(),
-                    cmdclass=dict(build_ext=build_ext),
+                    ext_modules=get_extensions(),
+                    cmdclass=get_cmdclass(),
                     zip_safe=False,
                     download_url=git_url,
                     install_requires=required_packages,